@@ -2,3 +2,9 @@ class CardDetectionError(Exception):
     def __init__(self, message: str) -> None:
         self.message = message
         super().__init__(message)
+
+
+class ImageDecodeError(Exception):
+    def __init__(self, message: str) -> None:
+        self.message = message
+        super().__init__(message)
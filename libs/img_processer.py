@@ -1,36 +1,219 @@
-import base64
-import sys
-from datetime import datetime
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
 import numpy as np
-from capybara import imwarp_quadrangle
+import onnxruntime as ort
+from capybara import Backend, order_points_clockwise
 from docaligner import DocAligner
 from loguru import logger
+from turbojpeg import TJFLAG_PROGRESSIVE, TJPF_BGR, TJSAMP_420, TurboJPEG
 
-sys.path.append(str(Path(__file__).parent.parent))  # noqa
-from libs.errors import CardDetectionError
-from libs.utils import IMAGES_DIR
+try:
+    # pybase64 使用 SIMD (AVX2/NEON) 加速 base64 編解碼
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from libs.errors import CardDetectionError, ImageDecodeError
+from libs.utils import IMAGES_DIR, write_file
 
 MAX_IMAGES_COUNT = 30
 
+# 啟用 OpenCV 的 SIMD 最佳化路徑，並限制其執行緒數（與 ONNX Runtime 共用 CPU）
+CV_NUM_THREADS_INT = min(4, os.cpu_count() or 1)
+cv2.setUseOptimized(True)
+cv2.setNumThreads(CV_NUM_THREADS_INT)
+logger.info(
+    f"OpenCV 執行緒數: {cv2.getNumThreads()}，"
+    f"SIMD 最佳化: {cv2.useOptimized()}"
+)
+
 OUTPUT_WIDTH_INT = 860
 OUTPUT_HEIGHT_INT = 540
 
-logger.info("正在載入 DocAligner 模型...")
-DOC_ALIGNER = DocAligner()
-logger.info("DocAligner 模型載入完成！")
+# 儲存校正結果的 JPEG 品質（4:2:0 取樣）
+# 以漸進式編碼輸出（libjpeg-turbo 的 progressive 會一併最佳化 Huffman 表），檔案更小且可逐步顯示
+SAVE_JPEG_QUALITY_INT = 85
+
+# 另存一份 WebP（同畫質下檔案更小），瀏覽器支援時由 /images 路由優先回傳
+SAVE_WEBP_QUALITY_INT = 85
+
+# 校正輸出影像的四個角（左上、右上、右下、左下）
+DST_CORNER_ARR = np.array(
+    [
+        [0, 0],
+        [OUTPUT_WIDTH_INT, 0],
+        [OUTPUT_WIDTH_INT, OUTPUT_HEIGHT_INT],
+        [0, OUTPUT_HEIGHT_INT],
+    ],
+    dtype=np.float32,
+)
+
+# 角點偵測用影像的最長邊（模型本身以 256x256 推論，不需要完整解析度）
+DETECT_MAX_SIDE_INT = 1024
+
+# 上傳圖片的像素數上限（先讀 JPEG 檔頭判斷，過大的圖片不做完整解碼）
+MAX_DECODE_PIXELS_INT = 64 * 1024 * 1024
+
+# 只有不超過此像素數的圖片（前端縮到 1920 寬的傳輸尺寸）才解碼到重用緩衝區，
+# 偶發的大圖每次另行配置，避免每個 worker thread 長期佔住大塊記憶體
+MAX_REUSE_DECODE_PIXELS_INT = 1920 * 1920
+
+# libjpeg-turbo 的 SIMD JPEG 編解碼器（capybara 本身也依賴它）
+TURBO_JPEG = TurboJPEG()
+
+# onnxruntime 編譯時支援 CUDA 時以 GPU 推論，否則退回 CPU
+# （Linux 上一律安裝 onnxruntime-gpu，CPU-only 主機會在建立 session 時退回 CPU，
+# 實際使用的 provider 於載入後另行記錄）
+DOC_ALIGNER_BACKEND = (
+    Backend.cuda
+    if "CUDAExecutionProvider" in ort.get_available_providers()
+    else Backend.cpu
+)
+
+# ONNX Runtime 的 intra-op 執行緒數，明確設定以免與 OpenCV 及 worker 執行緒互搶 CPU
+ORT_INTRA_OP_THREADS_INT = min(4, os.cpu_count() or 1)
+
+# 模型設定：fastvit_sa24（預設）、fastvit_t8、lcnet100（backbone 較輕量）
+DOC_ALIGNER_MODEL_CFG = os.environ.get("DOCALIGNER_MODEL_CFG", "fastvit_sa24")
+
+logger.info(
+    f"正在載入 DocAligner 模型（{DOC_ALIGNER_MODEL_CFG}, "
+    f"請求的 backend: {DOC_ALIGNER_BACKEND.name}）..."
+)
+DOC_ALIGNER = DocAligner(
+    model_cfg=DOC_ALIGNER_MODEL_CFG,
+    backend=DOC_ALIGNER_BACKEND,
+    session_option={"intra_op_num_threads": ORT_INTRA_OP_THREADS_INT},
+)
+DOC_ALIGNER_PROVIDER_LIST = DOC_ALIGNER.detector.model.providers
+logger.info(f"DocAligner 模型載入完成！實際使用的 provider: {DOC_ALIGNER_PROVIDER_LIST}")
+if (
+    DOC_ALIGNER_BACKEND == Backend.cuda
+    and "CUDAExecutionProvider" not in DOC_ALIGNER_PROVIDER_LIST
+):
+    logger.warning("此主機無法使用 CUDA，DocAligner 已退回 CPU 推論")
+
+# 以空白影像先推論與編碼一次，讓 ONNX Runtime 及 JPEG/WebP 編碼器的首次初始化
+# 不落在第一個上傳請求上
+try:
+    DOC_ALIGNER(img=np.zeros((640, 640, 3), np.uint8), do_center_crop=True)
+    warm_up_bgr_img = np.zeros((OUTPUT_HEIGHT_INT, OUTPUT_WIDTH_INT, 3), np.uint8)
+    TURBO_JPEG.encode(
+        warm_up_bgr_img,
+        quality=SAVE_JPEG_QUALITY_INT,
+        pixel_format=TJPF_BGR,
+        jpeg_subsample=TJSAMP_420,
+        flags=TJFLAG_PROGRESSIVE,
+    )
+    cv2.imencode(
+        ".webp",
+        warm_up_bgr_img,
+        [cv2.IMWRITE_WEBP_QUALITY, SAVE_WEBP_QUALITY_INT],
+    )
+except Exception as e:
+    logger.warning(f"暖機失敗: {e}")
+
+# 推論一次只跑一張：多個上傳同時推論只會互搶 ONNX Runtime 的 intra-op 執行緒
+DOC_ALIGNER_LOCK = threading.Lock()
+
+# 已儲存圖片路徑（由舊到新）：啟動時依 mtime 排序一次，之後只在存檔時 append
+with os.scandir(IMAGES_DIR) as dir_entry_iter:
+    jpg_entry_list = [
+        dir_entry
+        for dir_entry in dir_entry_iter
+        if dir_entry.name.endswith(".jpg") and dir_entry.is_file()
+    ]
+jpg_entry_list.sort(key=lambda dir_entry: dir_entry.stat().st_mtime)
+SAVED_PATHS: deque[Path] = deque(
+    Path(dir_entry.path) for dir_entry in jpg_entry_list
+)
+SAVED_PATHS_LOCK = threading.Lock()
+
+# 清理舊圖片的背景執行緒（單一 worker，依序執行）
+CLEANUP_EXECUTOR = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="img_cleanup",
+)
+
+# 每個 worker thread 各自重用解碼結果與偵測用縮圖的緩衝區，避免每次上傳重新配置
+WORKER_BUFFER_LOCAL = threading.local()
+
+# 存檔/刪檔改為彙總日誌，每 SAVE_REPORT_INTERVAL_FLOAT 秒最多輸出一行
+SAVE_REPORT_INTERVAL_FLOAT = 5.0
+save_stats_dict = {
+    "saved_count": 0,
+    "deleted_count": 0,
+    "last_report_ts": time.monotonic(),
+}
+
+# 存檔序號：同一個 time_ns 下連續存檔時仍保證檔名不重複
+SAVE_SEQ_COUNTER = itertools.count()
+
+
+def warp_card(
+    bgr_img: np.ndarray,
+    poly_arr: np.ndarray,
+) -> np.ndarray:
+    """ 依四個角點將卡片透視校正為 OUTPUT_WIDTH_INT x OUTPUT_HEIGHT_INT """
+    src_corner_arr = order_points_clockwise(poly_arr.astype(np.float32))
+    matrix = cv2.getPerspectiveTransform(src_corner_arr, DST_CORNER_ARR)
+    return cv2.warpPerspective(
+        bgr_img,
+        matrix,
+        (OUTPUT_WIDTH_INT, OUTPUT_HEIGHT_INT),
+        flags=cv2.INTER_LINEAR,
+    )
 
 
-def get_flat_rgb_img(
+def get_flat_bgr_img(
     bgr_img: np.ndarray,
 ) -> np.ndarray:
     """ 偵測卡片並進行透視校正
     Raises:
         CardDetectionError: 未偵測到卡片
     """
-    poly_arr = DOC_ALIGNER(img=bgr_img, do_center_crop=True)
+    # 在縮小的影像上偵測角點，再把座標換算回原圖
+    img_height_int, img_width_int = bgr_img.shape[:2]
+    scale_float = min(
+        1.0,
+        DETECT_MAX_SIDE_INT / max(img_height_int, img_width_int),
+    )
+    if scale_float < 1.0:
+        detect_width_int = round(img_width_int * scale_float)
+        detect_height_int = round(img_height_int * scale_float)
+        detect_buffer = getattr(WORKER_BUFFER_LOCAL, "detect_bgr_img", None)
+        if detect_buffer is None or detect_buffer.shape[:2] != (
+            detect_height_int,
+            detect_width_int,
+        ):
+            detect_buffer = np.empty(
+                (detect_height_int, detect_width_int, 3),
+                dtype=np.uint8,
+            )
+            WORKER_BUFFER_LOCAL.detect_bgr_img = detect_buffer
+        detect_bgr_img = cv2.resize(
+            bgr_img,
+            (detect_width_int, detect_height_int),
+            dst=detect_buffer,
+            interpolation=cv2.INTER_AREA,
+        )
+    else:
+        detect_bgr_img = bgr_img
+
+    with DOC_ALIGNER_LOCK:
+        poly_arr = DOC_ALIGNER(img=detect_bgr_img, do_center_crop=True)
+        # 縮圖上偵測失敗時，退回以原圖再偵測一次
+        if len(poly_arr) != 4 and scale_float < 1.0:
+            logger.debug("縮圖偵測失敗，改用原圖偵測")
+            poly_arr = DOC_ALIGNER(img=bgr_img, do_center_crop=True)
+            scale_float = 1.0
     poly_len_int = len(poly_arr)
     if poly_len_int != 4:
         raise CardDetectionError(
@@ -38,75 +221,177 @@ def get_flat_rgb_img(
         )
 
     logger.success("偵測到卡片！正在進行透視校正...")
-    rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
-    flat_rgb_img = imwarp_quadrangle(
-        img=rgb_img,
-        polygon=poly_arr,
-        dst_size=(OUTPUT_WIDTH_INT, OUTPUT_HEIGHT_INT),
+    # 透視校正與通道順序無關，全程維持 BGR（JPEG 編碼也直接吃 BGR）
+    flat_bgr_img = warp_card(
+        bgr_img=bgr_img,
+        poly_arr=poly_arr / scale_float,
     )
-    return flat_rgb_img
+    return flat_bgr_img
 
 
-def save_corrected_image(rgb_img: np.ndarray) -> Path | None:
-    timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    filename = f"corrected_{timestamp_str}.jpg"
-    filepath = IMAGES_DIR / filename
+def cleanup_old_images() -> None:
+    """ 刪除超過 MAX_IMAGES_COUNT 張的最舊圖片，並定期輸出彙總日誌 """
+    with SAVED_PATHS_LOCK:
+        oldest_path_list = [
+            SAVED_PATHS.popleft()
+            for _ in range(len(SAVED_PATHS) - MAX_IMAGES_COUNT)
+        ]
 
-    # 轉換 RGB 到 BGR
-    bgr_img = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2BGR)
+    for oldest_path in oldest_path_list:
+        oldest_path.unlink(missing_ok=True)
+        oldest_path.with_suffix(".webp").unlink(missing_ok=True)
+        logger.debug(f"已刪除舊圖片: {oldest_path.name}")
 
-    # 使用 imencode + 手動寫入（避免 cv2.imwrite 中文路徑問題）
-    success, buffer = cv2.imencode(
-        ".jpg",
+    with SAVED_PATHS_LOCK:
+        save_stats_dict["deleted_count"] += len(oldest_path_list)
+        now_ts = time.monotonic()
+        if now_ts - save_stats_dict["last_report_ts"] >= SAVE_REPORT_INTERVAL_FLOAT:
+            logger.info(
+                f"已儲存 {save_stats_dict['saved_count']} 張圖片，"
+                f"刪除 {save_stats_dict['deleted_count']} 張舊圖片"
+            )
+            save_stats_dict["saved_count"] = 0
+            save_stats_dict["deleted_count"] = 0
+            save_stats_dict["last_report_ts"] = now_ts
+
+
+def save_corrected_image(bgr_img: np.ndarray) -> Path:
+    """ 編碼並儲存校正後圖片，回傳存檔路徑
+    Raises:
+        OSError: 寫入檔案失敗
+    """
+    # 以 time_ns + 序號命名：可排序、不會撞名，且免去 strftime 的格式化成本
+    timestamp_ns_int = time.time_ns()
+    filename = f"corrected_{timestamp_ns_int}_{next(SAVE_SEQ_COUNTER)}.jpg"
+    filepath = IMAGES_DIR / filename
+
+    # 在記憶體中編碼 + 手動寫入（避免 cv2.imwrite 中文路徑問題）
+    jpeg_bytes = TURBO_JPEG.encode(
         bgr_img,
-        [cv2.IMWRITE_JPEG_QUALITY, 98],
+        quality=SAVE_JPEG_QUALITY_INT,
+        pixel_format=TJPF_BGR,
+        jpeg_subsample=TJSAMP_420,
+        flags=TJFLAG_PROGRESSIVE,
     )
-    if not success:
-        raise ValueError("圖片編碼失敗")
 
     # 手動寫入檔案（支援中文路徑）
-    with open(filepath, "wb") as f:
-        f.write(buffer.tobytes())
-    logger.info(f"已儲存校正後圖片: {filename}")
-
-    # 刪除過多的圖片
-    image_path_list = sorted(
-        IMAGES_DIR.glob("*.jpg"),
-        key=lambda p: p.stat().st_mtime,
+    write_file(filepath, jpeg_bytes)
+    is_success, webp_arr = cv2.imencode(
+        ".webp",
+        bgr_img,
+        [cv2.IMWRITE_WEBP_QUALITY, SAVE_WEBP_QUALITY_INT],
     )
-    while len(image_path_list) > MAX_IMAGES_COUNT:
-        oldest_path = image_path_list.pop(0)
-        oldest_path.unlink()
-        logger.info(f"已刪除舊圖片: {oldest_path.name}")
+    if is_success:
+        write_file(filepath.with_suffix(".webp"), webp_arr)
+    logger.debug(f"已儲存校正後圖片: {filename}")
+
+    with SAVED_PATHS_LOCK:
+        SAVED_PATHS.append(filepath)
+        save_stats_dict["saved_count"] += 1
+
+    # 刪除過多的圖片（丟到背景執行緒，不拖慢回應）
+    CLEANUP_EXECUTOR.submit(cleanup_old_images)
 
     return filepath
 
 
-def to_bgr_img(img_b64_str: str) -> np.ndarray:
-    if "," in img_b64_str:
-        img_b64_str = img_b64_str.split(",")[1]
-    return cv2.imdecode(
-        np.frombuffer(base64.b64decode(img_b64_str), np.uint8),
-        flags=cv2.IMREAD_COLOR_BGR,
-    )
+def bytes_to_bgr_img(
+    img_bytes: bytes,
+    is_reuse_buffer: bool = False,
+) -> np.ndarray:
+    """ 圖片 bytes 轉 BGR 影像
+    JPEG 先只解析檔頭取得尺寸，過大的圖片在完整解碼前就拒絕；
+    其他格式沒有輕量的檔頭解析可用，解碼本身只受 OpenCV 的
+    CV_IO_MAX_IMAGE_PIXELS（預設 2^30 像素）限制，解碼後再檢查尺寸
+    is_reuse_buffer: JPEG 解碼到此 thread 重用的緩衝區（下次呼叫會被覆寫，
+        只適用於用完即丟的處理流程；超過 MAX_REUSE_DECODE_PIXELS_INT 時不重用）
+    Raises:
+        ImageDecodeError: 圖片內容為空、過大或無法解碼
+    """
+    if not img_bytes:
+        raise ImageDecodeError(message="圖片內容為空")
+    try:
+        width_int, height_int, _, _ = TURBO_JPEG.decode_header(img_bytes)
+    except OSError:
+        # 非 JPEG（或 libjpeg-turbo 無法解析）時交給 OpenCV
+        try:
+            bgr_img = cv2.imdecode(
+                np.frombuffer(img_bytes, np.uint8),
+                flags=cv2.IMREAD_COLOR_BGR,
+            )
+        except cv2.error as e:
+            raise ImageDecodeError(message=f"無法解碼圖片: {e}") from e
+        if bgr_img is None:
+            raise ImageDecodeError(message="無法解碼圖片")
+        height_int, width_int = bgr_img.shape[:2]
+        if width_int * height_int > MAX_DECODE_PIXELS_INT:
+            raise ImageDecodeError(
+                message=f"圖片尺寸過大: {width_int}x{height_int}",
+            )
+        return bgr_img
 
+    logger.debug("收到圖片: {}x{}", width_int, height_int)
+    # 截斷的檔案（只有檔頭）decode_header 只發出警告並回傳 -1 的尺寸
+    if width_int <= 0 or height_int <= 0:
+        raise ImageDecodeError(
+            message=f"無法解析圖片尺寸: {width_int}x{height_int}",
+        )
+    if width_int * height_int > MAX_DECODE_PIXELS_INT:
+        raise ImageDecodeError(
+            message=f"圖片尺寸過大: {width_int}x{height_int}",
+        )
+    decode_buffer = None
+    if is_reuse_buffer and width_int * height_int > MAX_REUSE_DECODE_PIXELS_INT:
+        # 同時釋放先前留下的緩衝區，讓此 thread 只保留傳輸尺寸以內的記憶體
+        WORKER_BUFFER_LOCAL.decode_bgr_img = None
+    elif is_reuse_buffer:
+        decode_buffer = getattr(WORKER_BUFFER_LOCAL, "decode_bgr_img", None)
+        if decode_buffer is None or decode_buffer.shape[:2] != (
+            height_int,
+            width_int,
+        ):
+            decode_buffer = np.empty((height_int, width_int, 3), dtype=np.uint8)
+            WORKER_BUFFER_LOCAL.decode_bgr_img = decode_buffer
+    try:
+        return TURBO_JPEG.decode(
+            img_bytes,
+            pixel_format=TJPF_BGR,
+            dst=decode_buffer,
+        )
+    except OSError as e:
+        raise ImageDecodeError(message=f"無法解碼圖片: {e}") from e
 
-def to_img_b64_str(
-    rgb_img: np.ndarray,
-    jpeg_quality_int: int = 95,
-) -> str:
-    bgr_img = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2BGR)
-    success_bool, buffer = cv2.imencode(
-        ".jpg",
-        bgr_img,
-        [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality_int],
-    )
-    if not success_bool:
-        raise ValueError("圖片編碼失敗")
-    return f"data:image/jpeg;base64,{base64.b64encode(buffer).decode('utf-8')}"
+
+def to_bgr_img(
+    img_b64_str: str | bytes,
+    is_reuse_buffer: bool = False,
+) -> np.ndarray:
+    """ base64（可含 data URI 前綴）轉 BGR 影像，str 與 bytes 皆可
+    is_reuse_buffer: 同 bytes_to_bgr_img
+    Raises:
+        ImageDecodeError: base64 格式錯誤、圖片過大或無法解碼
+    """
+    if isinstance(img_b64_str, str):
+        data_prefix, sep = "data:", ","
+    else:
+        data_prefix, sep = b"data:", b","
+    # 只在 data URI 時定位逗號，避免對整段 payload 做 `in` 掃描與 split 配置
+    if img_b64_str.startswith(data_prefix):
+        img_b64_str = img_b64_str.partition(sep)[2]
+    try:
+        # validate=True 走 pybase64 的 SIMD 快速路徑（非法字元直接報錯而非逐字略過）
+        img_bytes = base64.b64decode(img_b64_str, validate=True)
+    except ValueError:
+        # 含換行（如 MIME 每 76 字換行）等非字母表字元時，退回略過這些字元的一般解碼
+        try:
+            img_bytes = base64.b64decode(img_b64_str, validate=False)
+        except ValueError as e:
+            raise ImageDecodeError(message=f"無法解碼 base64: {e}") from e
+    return bytes_to_bgr_img(img_bytes, is_reuse_buffer=is_reuse_buffer)
 
 
 if __name__ == "__main__":
+    # 於專案根目錄以 `python -m libs.img_processer` 執行
     import pylab as plt
     img_path = Path(__file__).parent.parent / "tests/imgs" / "S__44711952.jpg"
     bgr_img = cv2.imdecode(
@@ -115,6 +400,6 @@ if __name__ == "__main__":
             dtype=np.uint8
         ), flags=cv2.IMREAD_COLOR_BGR
     )
-    flat_rgb_img = get_flat_rgb_img(bgr_img)
-    plt.imshow(flat_rgb_img)
+    flat_bgr_img = get_flat_bgr_img(bgr_img)
+    plt.imshow(flat_bgr_img[..., ::-1])
     plt.show()
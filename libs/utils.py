@@ -1,5 +1,20 @@
+import os
 from pathlib import Path
 
 # 設定圖片儲存路徑
 IMAGES_DIR = Path(__file__).parent / "images"
 IMAGES_DIR.mkdir(exist_ok=True)
+
+
+def write_file(filepath: Path, data) -> None:
+    """ 以 os.open/os.write 直接寫入檔案（略過 Python 的緩衝 IO 層）
+    data 可為任何支援 buffer protocol 的物件（bytes、np.ndarray 等）
+    """
+    view = memoryview(data).cast("B")
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while view:
+            written_int = os.write(fd, view)
+            view = view[written_int:]
+    finally:
+        os.close(fd)
@@ -1,29 +1,115 @@
+import asyncio
+import functools
+import gzip
+import os
+import stat
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from fastapi import Request
-from fastapi.responses import JSONResponse
+import numpy as np
+import orjson
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from loguru import logger
 from nicegui import app, ui
 from pydantic import BaseModel
 
-sys.path.append(str(Path(__file__).parent.parent))  # noqa
-from libs.errors import CardDetectionError
+from libs.errors import CardDetectionError, ImageDecodeError
 from libs.img_processer import (
-    get_flat_rgb_img,
+    bytes_to_bgr_img,
+    get_flat_bgr_img,
     save_corrected_image,
     to_bgr_img,
 )
 from libs.utils import IMAGES_DIR
 
+STATIC_DIR = Path(__file__).parent / "static"
+
+# 靜態檔案一律以 ?v= 版本號引用，內容變更時改版本號即可，因此可讓瀏覽器快取一年
+STATIC_MAX_CACHE_AGE_INT = 365 * 24 * 60 * 60
+
+# webcam.js 在啟動時讀入並預先 gzip 一次，之後直接由記憶體回傳
+# （已帶 Content-Encoding，GZipMiddleware 不會再逐次壓縮）
+WEBCAM_JS_BYTES = (STATIC_DIR / "webcam.js").read_bytes()
+WEBCAM_JS_GZIP_BYTES = gzip.compress(WEBCAM_JS_BYTES, compresslevel=9)
+WEBCAM_JS_HEADERS_DICT = {
+    "Cache-Control": f"public, max-age={STATIC_MAX_CACHE_AGE_INT}, immutable",
+    "Vary": "Accept-Encoding",
+}
+
+
+# 需註冊在 /static 掛載之前，才會優先於 StaticFiles 比對
+@app.get("/static/webcam.js")
+async def get_webcam_js(request: Request) -> Response:
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(
+            WEBCAM_JS_GZIP_BYTES,
+            media_type="text/javascript",
+            headers={**WEBCAM_JS_HEADERS_DICT, "Content-Encoding": "gzip"},
+        )
+    return Response(
+        WEBCAM_JS_BYTES,
+        media_type="text/javascript",
+        headers=WEBCAM_JS_HEADERS_DICT,
+    )
+
+
 # 設定靜態檔案路徑
-app.add_static_files("/static", str(Path(__file__).parent / "static"))
-app.add_static_files("/images", str(IMAGES_DIR))
+app.add_static_files(
+    "/static",
+    str(STATIC_DIR),
+    max_cache_age=STATIC_MAX_CACHE_AGE_INT,
+)
 logger.info(f"圖片目錄: {IMAGES_DIR}")
 
+# 校正後圖片的檔名每次都不同、內容也不會再變，可標記為 immutable 長期快取
+# 同一網址會依 Accept 回傳 JPEG 或 WebP，快取需以 Accept 區分
+IMAGE_CACHE_HEADERS_DICT = {
+    "Cache-Control": f"public, max-age={STATIC_MAX_CACHE_AGE_INT}, immutable",
+    "Vary": "Accept",
+}
+
+# 同時處理中的上傳數上限（避免磁碟或 CPU 慢時堆積過多 worker thread）
+MAX_CONCURRENT_UPLOADS_INT = 4
+UPLOAD_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS_INT)
+
+# 影像處理專用的常駐 thread pool（解碼、偵測、校正、存檔），
+# 與預設 executor 分開，一個上傳的解碼可與另一個上傳的推論重疊進行
+IMAGE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_UPLOADS_INT,
+    thread_name_prefix="img_worker",
+)
+
+# 上傳 body 的大小上限（超過直接回應 413，限制每個上傳佔用的記憶體）
+MAX_UPLOAD_BYTES_INT = 20 * 1024 * 1024
+
+# 前端上傳前的縮圖寬度與 JPEG 品質（注入到 webcam.js，前後端共用同一份設定）
+# 校正輸出只有 860x540，但卡片只佔畫面一部分，寬度需保留足夠像素
+MAX_TRANSFER_WIDTH_INT = 1920
+TRANSFER_JPEG_QUALITY_FLOAT = 0.8
+
+# 頁面用到的 JavaScript 呼叫（實作都在 webcam.js，這裡只送出一行呼叫）
+# 初始化攝像頭，完成後 webcam.js 以 emitEvent('webcam_ready', ...) 通知
+INIT_CAMERA_JS = """
+if (typeof WebcamCapture === 'undefined') {
+    console.error('[webcam] WebcamCapture 未定義！');
+    emitEvent('webcam_ready', JSON.stringify({error: 'WebcamCapture undefined'}));
+} else {
+    WebcamCapture.bootstrap('webcam-video');
+}
+"""
+
+# 拍照並上傳：圖片已經由 HTTP 送出，這裡只回傳 {success, img_url, error}，
+# 直接回傳物件，由 NiceGUI 反序列化成 dict
+CAPTURE_UPLOAD_JS = "WebcamCapture.captureAndUploadHTTP()"
+
+# 停止攝像頭並顯示校正結果（img_url 以 JSON 字串帶入）
+SHOW_RESULT_JS = "WebcamCapture.showResult({img_url_json})"
+
 
 class UploadPhotoPost(BaseModel):
-    image: str  # base64 encoded image
+    image: bytes  # base64 encoded image（以 bytes 接收，直接交給 pybase64 解碼）
 
 
 class UploadPhotoOut(BaseModel):
@@ -34,42 +120,177 @@ class UploadPhotoOut(BaseModel):
 async def card_detection_error_handler(
     request: Request,
     exc: CardDetectionError,
-) -> JSONResponse:
+) -> ORJSONResponse:
     logger.warning(f"卡片偵測失敗: {exc.message}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=422,
         content={"detail": exc.message},
     )
 
 
+@app.exception_handler(ImageDecodeError)
+async def image_decode_error_handler(
+    request: Request,
+    exc: ImageDecodeError,
+) -> ORJSONResponse:
+    logger.warning(f"圖片解碼失敗: {exc.message}")
+    return ORJSONResponse(
+        status_code=422,
+        content={"detail": exc.message},
+    )
+
+
+async def run_in_image_executor(func, /, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        IMAGE_EXECUTOR,
+        functools.partial(func, *args, **kwargs),
+    )
+
+
+async def warm_up_image_executor() -> None:
+    """ 啟動時在 IMAGE_EXECUTOR 上以空白影像跑一次偵測流程
+    （模型本身在 import 時已暖機，這裡讓縮圖與 worker thread 的首次成本不落在第一個上傳）
+    """
+    try:
+        await run_in_image_executor(
+            get_flat_bgr_img,
+            bgr_img=np.zeros((1080, 1920, 3), np.uint8),
+        )
+    except CardDetectionError:
+        pass  # 空白影像本來就偵測不到卡片
+    except Exception as e:
+        logger.warning(f"影像處理暖機失敗: {e}")
+
+
+app.on_startup(warm_up_image_executor)
+
+
+async def read_request_body(request: Request) -> bytearray:
+    """ 依 Content-Length 預先配置緩衝區，邊接收邊寫入
+    （省去 request.body() 先收集 chunk 再 join 的整份複製）
+    Raises:
+        HTTPException: body 超過 MAX_UPLOAD_BYTES_INT（回應 413）
+    """
+    content_length_int = int(request.headers.get("content-length") or 0)
+    if content_length_int > MAX_UPLOAD_BYTES_INT:
+        raise HTTPException(status_code=413, detail="上傳的圖片過大")
+    body_buffer = bytearray(content_length_int)
+    offset_int = 0
+    async for chunk in request.stream():
+        # 沒有 Content-Length（chunked）或實際內容超出宣告時，邊收邊檢查
+        if offset_int + len(chunk) > MAX_UPLOAD_BYTES_INT:
+            raise HTTPException(status_code=413, detail="上傳的圖片過大")
+        # 超出預先配置的長度時，slice 指派會自動擴充緩衝區
+        body_buffer[offset_int:offset_int + len(chunk)] = chunk
+        offset_int += len(chunk)
+    del body_buffer[offset_int:]
+    return body_buffer
+
+
+def process_photo(decode_func, img_data) -> str:
+    """ 解碼 → 偵測卡片、透視校正 → 存檔，整段在同一個 worker thread 內完成
+    回傳校正後圖片的 URL
+    Raises:
+        ImageDecodeError: 圖片過大或無法解碼
+        CardDetectionError: 未偵測到卡片
+    """
+    # 解碼結果用完即丟，可解碼到該 worker thread 重用的緩衝區
+    flat_bgr_img = get_flat_bgr_img(
+        bgr_img=decode_func(img_data, is_reuse_buffer=True),
+    )
+    logger.info("卡片擷取成功！")
+    # 存檔失敗會直接拋出例外，回傳的路徑必定存在，不需再 stat 確認
+    saved_path = save_corrected_image(flat_bgr_img)
+    img_url = f"/images/{saved_path.name}"
+    logger.info(f"圖片 URL: {img_url}")
+    return img_url
+
+
+async def correct_and_save(decode_func, img_data) -> UploadPhotoOut:
+    """ 將整條處理流程一次丟到 IMAGE_EXECUTOR（只切換一次 thread，不卡住 event loop）
+    Raises:
+        ImageDecodeError: 圖片過大或無法解碼
+        CardDetectionError: 未偵測到卡片
+    """
+    async with UPLOAD_SEMAPHORE:
+        img_url = await run_in_image_executor(process_photo, decode_func, img_data)
+    return UploadPhotoOut(img_url=img_url)
+
+
+def stat_regular_file(filepath: Path) -> os.stat_result | None:
+    """ 回傳一般檔案的 stat 結果，不存在、無法存取或不是一般檔案時回傳 None """
+    try:
+        stat_result = filepath.stat()
+    except (OSError, ValueError):
+        # 除了檔案不存在，檔名過長（ENAMETOOLONG）或含 NUL 字元（ValueError）也視為 404
+        return None
+    return stat_result if stat.S_ISREG(stat_result.st_mode) else None
+
+
+@app.get("/images/{filename}")
+async def get_image(request: Request, filename: str) -> FileResponse:
+    """ 直接回傳校正後圖片（不經 StaticFiles 的路徑解析）
+    瀏覽器接受 WebP 時，優先回傳同名的 .webp（檔案較小）
+    Raises:
+        HTTPException: 檔名不合法或圖片不存在
+    """
+    filepath = IMAGES_DIR / filename
+    # 只接受單純的檔名，避免路徑穿越
+    if filepath.name != filename:
+        raise HTTPException(status_code=404)
+
+    stat_result = None
+    if "image/webp" in request.headers.get("accept", ""):
+        webp_path = filepath.with_suffix(".webp")
+        stat_result = stat_regular_file(webp_path)
+        if stat_result is not None:
+            filepath = webp_path
+    if stat_result is None:
+        stat_result = stat_regular_file(filepath)
+        if stat_result is None:
+            raise HTTPException(status_code=404)
+
+    # 傳入 stat_result：FileResponse 直接據此設定 Content-Length/ETag/Last-Modified，
+    # 不必再丟到 thread 重新 stat 一次
+    return FileResponse(
+        filepath,
+        media_type="image/webp" if filepath.suffix == ".webp" else "image/jpeg",
+        headers=IMAGE_CACHE_HEADERS_DICT,
+        stat_result=stat_result,
+    )
+
+
 @app.post("/api/upload_photo")
 async def upload_photo_api(post: UploadPhotoPost) -> UploadPhotoOut:
     logger.info("收到 HTTP 上傳的圖片")
-    bgr_img = to_bgr_img(img_b64_str=post.image)
-    img_height_int, img_width_int = bgr_img.shape[:2]
-    logger.info(f"收到高解析度圖片: {img_width_int}x{img_height_int}")
+    return await correct_and_save(to_bgr_img, post.image)
 
-    flat_rgb_img = get_flat_rgb_img(bgr_img=bgr_img)
-    logger.info("卡片擷取成功！")
-    saved_path = save_corrected_image(flat_rgb_img)
-    if saved_path and saved_path.exists():
-        img_url = f"/images/{saved_path.name}"
-        logger.info(f"圖片 URL: {img_url}")
-    else:
-        logger.error(f"儲存的圖片不存在: {saved_path}")
-        img_url = ""
 
-    return UploadPhotoOut(img_url=img_url)
+@app.post("/api/upload_photo_bin")
+async def upload_photo_bin_api(request: Request) -> UploadPhotoOut:
+    """ 接收原始 JPEG 二進位內容（免去 base64 編解碼與 33% 的傳輸量）"""
+    logger.info("收到 HTTP 上傳的圖片（二進位）")
+    img_bytes = await read_request_body(request)
+    return await correct_and_save(bytes_to_bgr_img, img_bytes)
 
 
 @ui.page("/")
 def index_page():
     # 頁面狀態（每個 client 獨立）
-    is_processing = False
+    capture_lock = asyncio.Lock()
     is_camera_ready = False
 
-    # 加上版本號避免瀏覽器快取舊版 JavaScript
-    ui.add_head_html('<script src="/static/webcam.js?v=6"></script>')
+    # 加上版本號避免瀏覽器快取舊版 JavaScript（修改 webcam.js 時務必遞增）
+    ui.add_head_html('<script src="/static/webcam.js?v=9"></script>')
+    ui.add_head_html(f"""
+    <script>
+        Object.assign(WebcamCapture, {{
+            maxTransferWidth: {MAX_TRANSFER_WIDTH_INT},
+            transferJpegQuality: {TRANSFER_JPEG_QUALITY_FLOAT},
+        }});
+    </script>
+    """)
 
     # 全屏樣式
     ui.add_head_html("""
@@ -199,31 +420,26 @@ def index_page():
         # 處理攝像頭就緒事件
         def on_camera_ready(event_args) -> None:
             nonlocal is_camera_ready
-            import json
 
-            logger.debug(
-                f"收到 webcam_ready 事件, args={event_args}, type={type(event_args)}"
+            # lazy：未開啟 DEBUG 時不會對事件參數做 repr
+            logger.opt(lazy=True).debug(
+                "收到 webcam_ready 事件, args={}, type={}",
+                lambda: event_args,
+                lambda: type(event_args),
             )
 
-            # 處理不同格式的事件參數
-            resolution_dict = None
-
-            if isinstance(event_args, str):
-                try:
-                    resolution_dict = json.loads(event_args)
-                except json.JSONDecodeError as e:
-                    logger.warning(f"JSON 解析失敗: {e}")
-            elif isinstance(event_args, dict):
-                resolution_dict = event_args
-            elif isinstance(event_args, list) and len(event_args) > 0:
-                first_item = event_args[0]
-                if isinstance(first_item, str):
-                    try:
-                        resolution_dict = json.loads(first_item)
-                    except json.JSONDecodeError:
-                        pass
-                elif isinstance(first_item, dict):
-                    resolution_dict = first_item
+            # JS 端一律以 JSON 字串送出（單一參數可能被包成 list）
+            if isinstance(event_args, list):
+                event_args = event_args[0] if event_args else None
+            try:
+                resolution_dict = (
+                    orjson.loads(event_args)
+                    if isinstance(event_args, (str, bytes))
+                    else event_args
+                )
+            except orjson.JSONDecodeError as e:
+                logger.warning(f"JSON 解析失敗: {e}")
+                resolution_dict = None
 
             # 檢查是否有錯誤
             if resolution_dict and "error" in resolution_dict:
@@ -251,68 +467,55 @@ def index_page():
 
         # 拍照按鈕點擊處理（使用 HTTP 上傳）
         async def on_capture_click() -> None:
-            nonlocal is_processing
-
-            if is_processing:
+            # 已在處理中就忽略（避免連點造成重複的偵測與存檔）
+            if capture_lock.locked():
                 return
 
-            is_processing = True
-            capture_button.disable()
-            status_label.set_text("拍照處理中...")
-
-            try:
-                # 呼叫 JavaScript 拍照並透過 HTTP 上傳
-                result = await ui.run_javascript(
-                    """
-                    (async () => {
-                        const result = await WebcamCapture.captureAndUploadHTTP();
-                        return JSON.stringify(result);
-                    })()
-                    """,
-                    timeout=30.0,
-                )
+            async with capture_lock:
+                capture_button.disable()
+                status_label.set_text("拍照處理中...")
 
-                # 解析 JSON 結果
-                import json
-                if isinstance(result, str):
-                    result_dict = json.loads(result)
-                else:
-                    result_dict = result
-
-                logger.debug(f"HTTP 上傳結果: {result_dict}")
-
-                if result_dict.get("success"):
-                    img_url: str = result_dict.get("img_url", "")
-                    logger.info(f"卡片擷取成功: {img_url}")
-
-                    # 停止攝像頭並顯示結果
-                    ui.run_javascript(f"""
-                        WebcamCapture.stop();
-                        document.getElementById('video-container').classList.add('hidden');
-                        document.getElementById('result-container').classList.remove('hidden');
-                        document.getElementById('result-image').src = '{img_url}';
-                    """)
-
-                    # 隱藏拍照按鈕和狀態
-                    capture_button.classes(add="hidden")
-                    status_label.set_text("擷取成功！")
-
-                else:
-                    # 失敗：顯示錯誤訊息
-                    error_msg = result_dict.get("error", "未知錯誤")
-                    status_label.set_text(f"{error_msg}，請重試")
+                try:
+                    # 呼叫 JavaScript 拍照並透過 HTTP 上傳
+                    result_dict: dict = await ui.run_javascript(
+                        CAPTURE_UPLOAD_JS,
+                        timeout=30.0,
+                    )
+
+                    logger.opt(lazy=True).debug(
+                        "HTTP 上傳結果: {}",
+                        lambda: result_dict,
+                    )
+
+                    if result_dict.get("success"):
+                        img_url: str = result_dict.get("img_url", "")
+                        logger.info(f"卡片擷取成功: {img_url}")
+
+                        # 停止攝像頭並顯示結果
+                        ui.run_javascript(
+                            SHOW_RESULT_JS.format(
+                                img_url_json=orjson.dumps(img_url).decode(),
+                            )
+                        )
+
+                        # 隱藏拍照按鈕和狀態
+                        capture_button.classes(add="hidden")
+                        status_label.set_text("擷取成功！")
+
+                    else:
+                        # 失敗：顯示錯誤訊息
+                        error_msg = result_dict.get("error", "未知錯誤")
+                        status_label.set_text(f"{error_msg}，請重試")
+                        capture_button.enable()
+
+                except TimeoutError:
+                    logger.error("拍照/上傳超時")
+                    status_label.set_text("拍照超時，請重試")
+                    capture_button.enable()
+                except Exception as e:
+                    logger.error(f"拍照/上傳錯誤: {e}")
+                    status_label.set_text(f"錯誤: {e}")
                     capture_button.enable()
-
-            except TimeoutError:
-                logger.error("拍照/上傳超時")
-                status_label.set_text("拍照超時，請重試")
-                capture_button.enable()
-            except Exception as e:
-                logger.error(f"拍照/上傳錯誤: {e}")
-                status_label.set_text(f"錯誤: {e}")
-                capture_button.enable()
-            finally:
-                is_processing = False
 
         capture_button.on_click(on_capture_click)
 
@@ -322,56 +525,22 @@ def index_page():
             status_label.set_text("狀態：正在啟動攝像頭...")
 
             # 執行 JavaScript 初始化攝像頭，成功後用 emitEvent 通知
-            # 注意：emitEvent 的第二個參數需要是字符串，所以使用 JSON.stringify
-            ui.run_javascript(
-                """
-                (async () => {
-                    console.log('[webcam] 開始初始化...');
-                    try {
-                        // 檢查 WebcamCapture 是否存在
-                        if (typeof WebcamCapture === 'undefined') {
-                            console.error('[webcam] WebcamCapture 未定義！');
-                            emitEvent('webcam_ready', JSON.stringify({error: 'WebcamCapture undefined'}));
-                            return;
-                        }
-
-                        // 檢查 video 元素是否存在
-                        const videoEl = document.getElementById('webcam-video');
-                        if (!videoEl) {
-                            console.error('[webcam] video 元素不存在！');
-                            emitEvent('webcam_ready', JSON.stringify({error: 'video element not found'}));
-                            return;
-                        }
-
-                        console.log('[webcam] 開始呼叫 init...');
-                        const success = await WebcamCapture.init('webcam-video');
-                        console.log('[webcam] init 結果:', success);
-
-                        if (success) {
-                            const resolution = WebcamCapture.getResolution();
-                            console.log('[webcam] 解析度:', resolution);
-                            const jsonStr = JSON.stringify(resolution);
-                            console.log('[webcam] 發送 emitEvent, data:', jsonStr);
-                            emitEvent('webcam_ready', jsonStr);
-                            console.log('[webcam] emitEvent 已發送');
-                        } else {
-                            console.error('[webcam] init 返回 false');
-                            emitEvent('webcam_ready', JSON.stringify({error: 'init returned false'}));
-                        }
-                    } catch (error) {
-                        console.error('[webcam] 初始化錯誤:', error);
-                        console.error('[webcam] 錯誤堆疊:', error.stack);
-                        emitEvent('webcam_ready', JSON.stringify({error: error.message || String(error)}));
-                    }
-                })();
-                """
-            )
+            ui.run_javascript(INIT_CAMERA_JS)
 
         # 頁面載入後自動初始化攝像頭
         ui.timer(0.5, init_camera, once=True)
 
 
+def setup_logger() -> None:
+    """ 以 INFO 取代 loguru 預設的 DEBUG 輸出等級（逐次的 debug 日誌不進入熱路徑）
+    沿用 loguru 本身的 LOGURU_LEVEL 環境變數調整，例如 LOGURU_LEVEL=DEBUG
+    """
+    logger.remove()
+    logger.add(sys.stderr, level=os.environ.get("LOGURU_LEVEL", "INFO"))
+
+
 def main() -> None:
+    setup_logger()
     port_int = 25331
     logger.info(f"啟動卡片擷取與校正，端口: {port_int}")
 
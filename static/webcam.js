@@ -9,6 +9,7 @@ const WebcamCapture = {
     imageCapture: null,
     isCapturing: false,
     captureInterval: null,
+    pendingUpload: null,
     highResJpegQuality: 0.95,
 
     // 列舉所有攝像頭設備
@@ -127,14 +128,25 @@ const WebcamCapture = {
     maxTransferWidth: 1920,
     transferJpegQuality: 0.85,
 
-    // 壓縮圖片以便傳輸（限制大小避免 WebSocket 超限）
+    // canvas 轉為 JPEG Blob（二進位，避免 base64 多出 33% 的大小）
+    canvasToJpegBlob(canvas) {
+        return new Promise((resolve, reject) => {
+            canvas.toBlob(
+                (blob) => blob ? resolve(blob) : reject(new Error('JPEG 編碼失敗')),
+                'image/jpeg',
+                this.transferJpegQuality
+            );
+        });
+    },
+
+    // 壓縮圖片以便傳輸（限制大小避免 WebSocket 超限），回傳 Promise<Blob>
     compressForTransfer(sourceCanvas) {
         const srcWidth = sourceCanvas.width;
         const srcHeight = sourceCanvas.height;
 
         // 如果已經小於傳輸限制，直接返回
         if (srcWidth <= this.maxTransferWidth) {
-            return sourceCanvas.toDataURL('image/jpeg', this.transferJpegQuality);
+            return this.canvasToJpegBlob(sourceCanvas);
         }
 
         // 計算壓縮後的尺寸
@@ -151,9 +163,8 @@ const WebcamCapture = {
         // 繪製壓縮後的圖片
         compressCtx.drawImage(sourceCanvas, 0, 0, newWidth, newHeight);
 
-        const base64Data = compressCanvas.toDataURL('image/jpeg', this.transferJpegQuality);
         console.log(`圖片已壓縮: ${srcWidth}x${srcHeight} -> ${newWidth}x${newHeight}`);
-        return base64Data;
+        return this.canvasToJpegBlob(compressCanvas);
     },
 
     // 高解析度拍照（優先使用 ImageCapture API，然後壓縮傳輸）
@@ -186,8 +197,7 @@ const WebcamCapture = {
                         console.log(`ImageCapture 拍照成功: ${img.width}x${img.height}`);
 
                         // 壓縮後傳輸
-                        const compressedData = this.compressForTransfer(tempCanvas);
-                        resolve(compressedData);
+                        this.compressForTransfer(tempCanvas).then(resolve, reject);
                     };
                     img.onerror = reject;
                     img.src = URL.createObjectURL(blob);
@@ -209,8 +219,7 @@ const WebcamCapture = {
         console.log(`Canvas 拍照成功: ${width}x${height}`);
 
         // 壓縮後傳輸
-        const compressedData = this.compressForTransfer(this.canvas);
-        return compressedData;
+        return await this.compressForTransfer(this.canvas);
     },
 
     // 擷取並壓縮畫面（用於預覽，保留但不再自動使用）
@@ -283,16 +292,54 @@ const WebcamCapture = {
         };
     },
 
-    // HTTP 上傳圖片（避免 WebSocket 大小限制）
-    async uploadPhotoHTTP(base64Data) {
+    // 初始化攝像頭，完成後以 emitEvent 通知 Python 端（參數需為字串，故用 JSON.stringify）
+    async bootstrap(videoElementId) {
+        console.log('[webcam] 開始初始化...');
+        try {
+            // 檢查 video 元素是否存在
+            if (!document.getElementById(videoElementId)) {
+                console.error('[webcam] video 元素不存在！');
+                emitEvent('webcam_ready', JSON.stringify({error: 'video element not found'}));
+                return;
+            }
+
+            console.log('[webcam] 開始呼叫 init...');
+            const success = await this.init(videoElementId);
+            console.log('[webcam] init 結果:', success);
+
+            if (success) {
+                const jsonStr = JSON.stringify(this.getResolution());
+                console.log('[webcam] 發送 emitEvent, data:', jsonStr);
+                emitEvent('webcam_ready', jsonStr);
+            } else {
+                console.error('[webcam] init 返回 false');
+                emitEvent('webcam_ready', JSON.stringify({error: 'init returned false'}));
+            }
+        } catch (error) {
+            console.error('[webcam] 初始化錯誤:', error);
+            console.error('[webcam] 錯誤堆疊:', error.stack);
+            emitEvent('webcam_ready', JSON.stringify({error: error.message || String(error)}));
+        }
+    },
+
+    // 停止攝像頭並顯示校正結果
+    showResult(imgUrl) {
+        this.stop();
+        document.getElementById('video-container').classList.add('hidden');
+        document.getElementById('result-container').classList.remove('hidden');
+        document.getElementById('result-image').src = imgUrl;
+    },
+
+    // HTTP 上傳圖片（避免 WebSocket 大小限制），直接傳送 JPEG 二進位內容
+    async uploadPhotoHTTP(jpegBlob) {
         try {
             console.log('使用 HTTP 上傳圖片...');
-            const response = await fetch('/api/upload_photo', {
+            const response = await fetch('/api/upload_photo_bin', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'image/jpeg'
                 },
-                body: JSON.stringify({ image: base64Data })
+                body: jpegBlob
             });
 
             const result = await response.json();
@@ -311,8 +358,23 @@ const WebcamCapture = {
         }
     },
 
-    // 拍照並透過 HTTP 上傳
+    // 拍照並透過 HTTP 上傳（同一時間只允許一張照片在處理，重複呼叫共用同一結果）
     async captureAndUploadHTTP() {
+        if (this.pendingUpload) {
+            console.log('已有上傳進行中，沿用該次結果');
+            return await this.pendingUpload;
+        }
+
+        this.pendingUpload = this.doCaptureAndUpload();
+        try {
+            return await this.pendingUpload;
+        } finally {
+            this.pendingUpload = null;
+        }
+    },
+
+    // 拍照並上傳的實際流程
+    async doCaptureAndUpload() {
         // 拍照
         const photoData = await this.captureHighResPhoto();
         if (!photoData) {